@@ -1,35 +1,81 @@
 import logging
+import os
+import shutil
+import struct
+import sys
 import tarfile
-from tempfile import TemporaryDirectory
+import zlib
+from tempfile import TemporaryFile
 from abc import ABC
-from dataclasses import dataclass
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+from dataclasses import dataclass, field
 from io import BytesIO
 from pathlib import Path
-from subprocess import run
-from textwrap import dedent
-from typing import List, Optional, Union
+from subprocess import PIPE, CalledProcessError, Popen
+from threading import Thread
+from typing import BinaryIO, Deque, Iterator, List, Literal, Optional, Tuple, Union
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# multi-threaded gzip, used instead of the in-process compressor when installed
+PIGZ = shutil.which("pigz")
+# level 6 is several times faster than 9 for a negligible size difference
+GZIP_LEVEL = 6
+# without pigz, gzip is compressed in blocks of this size on a thread pool
+GZIP_BLOCK_SIZE = 128 * 1024
+GZIP_WINDOW_SIZE = 32 * 1024
+# zstd members need dpkg >= 1.19 on the installing host
+ZSTD = shutil.which("zstd")
+ZSTD_LEVEL = 3
+
+# buffer for compressor pipes and for copying payloads without sendfile
+COPY_BUFSIZE = 1024 * 1024
+# data archives of more uncompressed content than this are kept on disk
+SPOOL_MAX_SIZE = 64 * 1024 * 1024
+
+# contents of the debian-binary member, the .deb format version
+DEBIAN_BINARY = b"2.0\n"
+
+Compression = Literal["gz", "zst"]
+
 
 # --- File Spec Types ---
 
 
-@dataclass
+@dataclass(slots=True)
 class TarFileSpec(ABC):
     path: str  # Path inside the archive (relative)
     mode: Optional[int]  # File mode (optional)
 
 
-@dataclass
+@dataclass(slots=True)
 class TextTarFileSpec(TarFileSpec):
     content: str
+    _encoded: bytes = field(init=False, repr=False, compare=False)
+    _size: int = field(init=False, repr=False, compare=False)
 
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        # keep the encoded payload in sync whenever content is (re)assigned
+        if name == "content":
+            object.__setattr__(self, "_encoded", value.encode("utf-8"))
+            object.__setattr__(self, "_size", len(self._encoded))
 
-@dataclass
+
+@dataclass(slots=True)
 class BinaryTarFileSpec(TarFileSpec):
     content: bytes
+    _encoded: bytes = field(init=False, repr=False, compare=False)
+    _size: int = field(init=False, repr=False, compare=False)
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name == "content":
+            object.__setattr__(self, "_encoded", value)
+            object.__setattr__(self, "_size", len(value))
 
 
 ContentTarFileSpec = Union[TextTarFileSpec, BinaryTarFileSpec]
@@ -38,7 +84,7 @@ ContentTarFileSpec = Union[TextTarFileSpec, BinaryTarFileSpec]
 # --- Config Structs ---
 
 
-@dataclass
+@dataclass(slots=True)
 class PackageMeta:
     name: str
     version: str
@@ -49,13 +95,28 @@ class PackageMeta:
         return f"{self.name}_{self.version}_{self.arch}.deb"
 
 
-@dataclass
+@dataclass(slots=True)
 class DebFileSpec:
     control_files: List[ContentTarFileSpec]
     data_files: List[ContentTarFileSpec]
 
 
-@dataclass
+CONTROL_TEMPLATE = (
+    "Package: %(name)s\n"
+    "Version: %(version)s\n"
+    "Depends: %(depends)s\n"
+    "Recommends: %(recommends)s\n"
+    "Section: %(section)s\n"
+    "Priority: %(priority)s\n"
+    "Homepage: %(homepage)s\n"
+    "Architecture: %(arch)s\n"
+    "Installed-Size: 10\n"
+    "Maintainer: %(maintainer)s\n"
+    "Description: %(description)s"
+)
+
+
+@dataclass(slots=True)
 class ControlExtras:
     depends: str = ""
     recommends: str = ""
@@ -66,106 +127,327 @@ class ControlExtras:
     description: str = ""
 
     def render(self, meta: PackageMeta) -> str:
-        return (
-            dedent(f"""\
-            Package: {meta.name}
-            Version: {meta.version}
-            Depends: {self.depends}
-            Recommends: {self.recommends}
-            Section: {self.section}
-            Priority: {self.priority}
-            Homepage: {self.homepage}
-            Architecture: {meta.arch}
-            Installed-Size: 10
-            Maintainer: {self.maintainer}
-            Description: {self.description}
-        """).strip()
-            + "\n"
-        )
+        fields = {
+            **{name: getattr(self, name) for name in self.__slots__},
+            "name": meta.name,
+            "version": meta.version,
+            "arch": meta.arch,
+        }
+        return (CONTROL_TEMPLATE % fields).strip() + "\n"
 
 
-@dataclass
+@dataclass(slots=True)
 class DebPackageConfig:
     meta: PackageMeta
     control: ControlExtras
     files: DebFileSpec
+    compression: Compression = "gz"
 
 
 # --- Archive Builder ---
 
 
+def _tar_info(name: str, mode: int, size: int = 0) -> tarfile.TarInfo:
+    info = tarfile.TarInfo(name=name)
+    info.size = size
+    info.mode = mode
+    # fixed ownership and timestamps keep the archive reproducible
+    info.mtime = 0
+    info.uid = info.gid = 0
+    info.uname = info.gname = ""
+    return info
+
+
 def create_tar_gz_bytes(
-    files: List[ContentTarFileSpec], base_dir: Optional[str] = None
+    files: List[ContentTarFileSpec],
+    base_dir: Optional[str] = None,
+    compression: Compression = "gz",
 ) -> bytes:
-    with TemporaryDirectory() as tmpdir:
-        tmp_path = Path(tmpdir)
-
-        # Write files into temp dir
+    buf = BytesIO()
+    create_tar_gz(buf, files, base_dir=base_dir, compression=compression)
+    return buf.getvalue()
+
+
+def create_tar_gz(
+    fileobj: BinaryIO,
+    files: List[ContentTarFileSpec],
+    base_dir: Optional[str] = None,
+    compression: Compression = "gz",
+) -> None:
+    """Write a compressed tar of ``files`` to ``fileobj``.
+
+    ``compression`` selects the format: ``"gz"`` for tar.gz, ``"zst"`` for tar.zst.
+    """
+    if base_dir:
+        # only the tree under base_dir is archived, as tar.add(base_dir) used to
+        files = [f for f in files if f.path.startswith(base_dir + "/")]
+
+    # Collect parent directories so they get their own entries
+    dirs = set()
+    if base_dir:
+        dirs.add(base_dir)
         for f in files:
-            full_path = tmp_path / f.path
-            full_path.parent.mkdir(parents=True, exist_ok=True)
-
-            if isinstance(f, TextTarFileSpec):
-                full_path.write_text(f.content)
-            elif isinstance(f, BinaryTarFileSpec):
-                full_path.write_bytes(f.content)
-            else:
-                raise Exception(f"unknown type: {type(f)} for {f}")
+            # stop at the first ancestor already seen, its parents are too
+            parent = f.path.rpartition("/")[0]
+            while parent not in dirs:
+                dirs.add(parent)
+                parent = parent.rpartition("/")[0]
+
+    # Stream the compressed tar into fileobj
+    entries = sorted([*dirs, *files], key=lambda e: e if isinstance(e, str) else e.path)
+    with _compressed(fileobj, compression) as stream:
+        with tarfile.open(
+            fileobj=stream,
+            mode="w|",
+            format=tarfile.GNU_FORMAT,
+            copybufsize=COPY_BUFSIZE,
+        ) as tar:
+            _add_entries(tar, entries)
+
+
+def _add_entries(
+    tar: tarfile.TarFile, entries: List[Union[str, ContentTarFileSpec]]
+) -> None:
+    for f in entries:
+        if isinstance(f, str):
+            info = _tar_info(f, 0o755)
+            info.type = tarfile.DIRTYPE
+            tar.addfile(info)
+            continue
+
+        if not isinstance(f, (TextTarFileSpec, BinaryTarFileSpec)):
+            raise Exception(f"unknown type: {type(f)} for {f}")
+
+        mode = f.mode if f.mode is not None else 0o644
+        tar.addfile(_tar_info(f.path, mode, f._size), BytesIO(f._encoded))
+
+
+@contextmanager
+def _compressed(fileobj: BinaryIO, compression: Compression) -> Iterator[BinaryIO]:
+    """Yield a stream whose writes end up compressed in ``fileobj``."""
+    if compression == "zst":
+        if not ZSTD:
+            raise Exception("zst compression requires the zstd command")
+        with _pipe_through([ZSTD, f"-{ZSTD_LEVEL}", "-T0", "-q", "-c"], fileobj) as s:
+            yield s
+    elif compression == "gz":
+        if PIGZ:
+            with _pipe_through([PIGZ, f"-{GZIP_LEVEL}", "-n"], fileobj) as s:
+                yield s
+        else:
+            with _ParallelGzipWriter(fileobj) as s:
+                yield s
+    else:
+        raise Exception(f"unknown compression: {compression}")
+
+
+@contextmanager
+def _pipe_through(cmd: List[str], fileobj: BinaryIO) -> Iterator[BinaryIO]:
+    """Yield the stdin of ``cmd``; its stdout is copied into ``fileobj``."""
+    # an absolute path and close_fds=False let subprocess use posix_spawn
+    # instead of fork+exec; our own descriptors are non-inheritable anyway
+    proc = Popen(cmd, stdin=PIPE, stdout=PIPE, close_fds=False, bufsize=COPY_BUFSIZE)
+    read_error: Optional[BaseException] = None
+
+    def read() -> None:
+        nonlocal read_error
+        try:
+            shutil.copyfileobj(proc.stdout, fileobj)
+        except BaseException as exc:
+            read_error = exc
+            # the writer may be blocked on a full pipe, a dead process unblocks it
+            proc.kill()
+
+    reader = Thread(target=read)
+    reader.start()
+    pipe_error: Optional[BrokenPipeError] = None
+    try:
+        yield proc.stdin
+        proc.stdin.close()
+    except BrokenPipeError as exc:
+        # the process went away, the reason is reported below
+        pipe_error = exc
+    except BaseException:
+        proc.kill()
+        raise
+    finally:
+        with suppress(BrokenPipeError):
+            proc.stdin.close()
+        reader.join()
+        proc.stdout.close()
+        proc.wait()
+    if read_error:
+        raise read_error
+    if proc.returncode:
+        raise CalledProcessError(proc.returncode, cmd) from pipe_error
+    if pipe_error:
+        raise pipe_error
+
+
+def _deflate_block(block: bytes, dictionary: bytes, last: bool) -> bytes:
+    co = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+    # a sync flush ends the block byte-aligned so the next one can follow it
+    return co.compress(block) + co.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class _ParallelGzipWriter:
+    """Gzip stream that deflates fixed-size blocks on a thread pool, like pigz.
+
+    Each block is compressed as raw deflate primed with the tail of the
+    previous block, and the pieces are concatenated in order between a
+    gzip header and the CRC32/ISIZE trailer.
+    """
+
+    def __init__(self, fileobj: BinaryIO, workers: Optional[int] = None):
+        self.fileobj = fileobj
+        workers = workers or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(workers)
+        self.max_pending = 2 * workers
+        self.pending: Deque[Future] = deque()
+        self.buf = bytearray()
+        self.dictionary = b""
+        self.crc = 0
+        self.size = 0
+        # no file name and a zero mtime, like gzip -n
+        fileobj.write(b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\x03")
+
+    def write(self, data: bytes) -> int:
+        self.buf += data
+        while len(self.buf) >= GZIP_BLOCK_SIZE:
+            self._submit(bytes(self.buf[:GZIP_BLOCK_SIZE]), last=False)
+            del self.buf[:GZIP_BLOCK_SIZE]
+        return len(data)
+
+    def _submit(self, block: bytes, last: bool) -> None:
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        self.pending.append(
+            self.pool.submit(_deflate_block, block, self.dictionary, last)
+        )
+        self.dictionary = block[-GZIP_WINDOW_SIZE:]
+        while len(self.pending) > self.max_pending:
+            self.fileobj.write(self.pending.popleft().result())
 
-            if f.mode is not None:
-                full_path.chmod(f.mode)
+    def close(self) -> None:
+        self._submit(bytes(self.buf), last=True)
+        self.buf.clear()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.pool.shutdown()
+        self.fileobj.write(struct.pack("<II", self.crc, self.size & 0xFFFFFFFF))
 
-        # Package into in-memory tar.gz
-        buf = BytesIO()
-        with tarfile.open(fileobj=buf, mode="w:gz", format=tarfile.GNU_FORMAT) as tar:
-            if base_dir:
-                tar.add(tmp_path / base_dir, arcname=base_dir)
-            else:
-                for f in files:
-                    tar.add(tmp_path / f.path, arcname=f.path)
+    def __enter__(self) -> "_ParallelGzipWriter":
+        return self
 
-        return buf.getvalue()
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.pool.shutdown(cancel_futures=True)
 
 
 # --- DEB Builder ---
 
 
-def build_deb(config: DebPackageConfig):
-    output_path = Path(config.meta.deb_filename)
-    with TemporaryDirectory() as tmpdir:
-        tmp_path = Path(tmpdir)
-        logger.info("Created workspace: %s", tmp_path)
+# name, mtime, uid, gid, octal mode, size and terminator, space padded
+_AR_HEADER = struct.Struct("16s12s6s6s8s10s2s")
 
-        # debian-binary
-        (tmp_path / "debian-binary").write_text("2.0\n")
 
-        # control.tar.gz
-        control_content = config.control.render(config.meta)
-        control_spec = TextTarFileSpec(
-            path="control", content=control_content, mode=None
-        )
-        control_bytes = create_tar_gz_bytes(config.files.control_files + [control_spec])
-        (tmp_path / "control.tar.gz").write_bytes(control_bytes)
+def _write_ar(
+    deb_path: Path, members: List[Tuple[str, Union[bytes, BinaryIO]]]
+) -> None:
+    """Write a System V ar archive, as produced by dpkg-deb."""
+    with open(deb_path, "wb") as dst:
+        dst.write(b"!<arch>\n")
+        for name, member in members:
+            if isinstance(member, bytes):
+                size = len(member)
+            else:
+                size = member.seek(0, os.SEEK_END)
+                member.seek(0)
+            dst.write(
+                _AR_HEADER.pack(
+                    name.encode().ljust(16),
+                    b"0".ljust(12),
+                    b"0".ljust(6),
+                    b"0".ljust(6),
+                    b"100644".ljust(8),
+                    str(size).encode().ljust(10),
+                    b"`\n",
+                )
+            )
+            if isinstance(member, bytes):
+                dst.write(member)
+            elif isinstance(member, BytesIO):
+                dst.write(member.getbuffer())
+            else:
+                _copy_file(member, dst, size)
+            if size % 2:
+                dst.write(b"\n")
 
-        # data.tar.gz
-        data_bytes = create_tar_gz_bytes(config.files.data_files, base_dir="usr")
-        (tmp_path / "data.tar.gz").write_bytes(data_bytes)
+
+def _copy_file(src: BinaryIO, dst: BinaryIO, size: int) -> None:
+    """Copy ``size`` bytes between real files, in-kernel where possible."""
+    # other platforms only sendfile into sockets
+    if sys.platform == "linux":
+        dst.flush()
+        offset = 0
+        while offset < size:
+            sent = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+            if not sent:
+                raise Exception(f"unexpected end of member after {offset} bytes")
+            offset += sent
+    else:
+        shutil.copyfileobj(src, dst, length=COPY_BUFSIZE)
+
+
+def _spool(size_hint: int) -> BinaryIO:
+    """Buffer in memory unless the payload may be large, then in an unnamed file."""
+    return BytesIO() if size_hint <= SPOOL_MAX_SIZE else TemporaryFile()
+
+
+def build_deb(config: DebPackageConfig):
+    output_path = Path(config.meta.deb_filename)
+    control_name = f"control.tar.{config.compression}"
+    data_name = f"data.tar.{config.compression}"
+
+    # control.tar.{gz,zst}
+    control_content = config.control.render(config.meta)
+    control_spec = TextTarFileSpec(path="control", content=control_content, mode=None)
+    control_buf = BytesIO()
+
+    # data.tar.{gz,zst}
+    data_size = sum(f._size for f in config.files.data_files)
+    with _spool(data_size) as data_buf:
+        # both archives compress in C with the GIL released, so run them together
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            control = pool.submit(
+                create_tar_gz,
+                control_buf,
+                config.files.control_files + [control_spec],
+                compression=config.compression,
+            )
+            data = pool.submit(
+                create_tar_gz,
+                data_buf,
+                config.files.data_files,
+                base_dir="usr",
+                compression=config.compression,
+            )
+            control.result()
+            data.result()
 
         # Build .deb
         logger.info("Creating .deb package: %s", output_path)
-        run(
+        _write_ar(
+            output_path,
             [
-                "ar",
-                "vr",
-                output_path.absolute(),
-                "debian-binary",
-                "control.tar.gz",
-                "data.tar.gz",
+                ("debian-binary", DEBIAN_BINARY),
+                (control_name, control_buf),
+                (data_name, data_buf),
             ],
-            cwd=tmp_path,
-            check=True,
         )
-        logger.info("Created .deb package: %s", output_path)
+    logger.info("Created .deb package: %s", output_path)
 
 
 # --- Entrypoint ---
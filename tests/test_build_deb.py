@@ -1,6 +1,228 @@
+import errno
+import gzip
+import os
+import shutil
+import subprocess
+import tarfile
+from io import BytesIO
 from logging import getLogger
 
+import pytest
+
+from simple_deb import build_deb
+from simple_deb.build_deb import (
+    BinaryTarFileSpec,
+    ControlExtras,
+    DebFileSpec,
+    DebPackageConfig,
+    PackageMeta,
+    TextTarFileSpec,
+    create_tar_gz_bytes,
+)
+
 logger = getLogger(__name__)
 
+
 def test_example():
     logger.info("hello from example")
+
+
+def test_create_tar_gz_bytes_with_base_dir():
+    archive = create_tar_gz_bytes(
+        [
+            TextTarFileSpec(path="usr/bin/hello", mode=0o755, content="#!/bin/sh\n"),
+            BinaryTarFileSpec(path="usr/share/hello/data", mode=None, content=b"\0"),
+        ],
+        base_dir="usr",
+    )
+
+    with tarfile.open(fileobj=BytesIO(archive)) as tar:
+        members = {m.name: m for m in tar.getmembers()}
+        assert list(members) == [
+            "usr",
+            "usr/bin",
+            "usr/bin/hello",
+            "usr/share",
+            "usr/share/hello",
+            "usr/share/hello/data",
+        ]
+        assert members["usr/share"].isdir()
+        assert members["usr/bin/hello"].mode == 0o755
+        assert members["usr/share/hello/data"].mode == 0o644
+        assert tar.extractfile("usr/bin/hello").read() == b"#!/bin/sh\n"
+
+
+@pytest.mark.skipif(not shutil.which("gzip"), reason="gzip not installed")
+def test_create_tar_gz_bytes_through_external_compressor(monkeypatch):
+    # gzip accepts the same flags as pigz
+    monkeypatch.setattr(build_deb, "PIGZ", shutil.which("gzip"))
+    archive = create_tar_gz_bytes(
+        [TextTarFileSpec(path="control", mode=None, content="Package: x\n")]
+    )
+
+    with tarfile.open(fileobj=BytesIO(archive)) as tar:
+        assert tar.getnames() == ["control"]
+        assert tar.extractfile("control").read() == b"Package: x\n"
+
+
+def _hello_config(compression="gz"):
+    return DebPackageConfig(
+        meta=PackageMeta(name="ab-hello", version="0.0.1", arch="amd64"),
+        control=ControlExtras(
+            maintainer="My Name <myemail@example.com>", description="ab-hello"
+        ),
+        files=DebFileSpec(
+            control_files=[],
+            data_files=[
+                TextTarFileSpec(
+                    path="usr/bin/ab-hello",
+                    content="#!/bin/sh\necho hello\n",
+                    mode=0o755,
+                )
+            ],
+        ),
+        compression=compression,
+    )
+
+
+@pytest.mark.skipif(not shutil.which("dpkg-deb"), reason="dpkg-deb not installed")
+@pytest.mark.parametrize(
+    "compression",
+    [
+        "gz",
+        pytest.param(
+            "zst",
+            marks=pytest.mark.skipif(
+                not shutil.which("zstd"), reason="zstd not installed"
+            ),
+        ),
+    ],
+)
+def test_build_deb(tmp_path, monkeypatch, compression):
+    monkeypatch.chdir(tmp_path)
+    build_deb.build_deb(_hello_config(compression))
+
+    deb = tmp_path / "ab-hello_0.0.1_amd64.deb"
+    info = subprocess.run(
+        ["dpkg-deb", "--field", deb, "Package", "Version"],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    assert info.stdout == "Package: ab-hello\nVersion: 0.0.1\n"
+    contents = subprocess.run(
+        ["dpkg-deb", "--contents", deb], check=True, capture_output=True, text=True
+    )
+    assert "usr/bin/ab-hello" in contents.stdout
+    assert f"data.tar.{compression}".encode() in deb.read_bytes()[:512]
+
+
+@pytest.mark.skipif(not shutil.which("dpkg-deb"), reason="dpkg-deb not installed")
+def test_build_deb_spools_large_data_to_file(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(build_deb, "SPOOL_MAX_SIZE", 0)
+    build_deb.build_deb(_hello_config())
+
+    contents = subprocess.run(
+        ["dpkg-deb", "--contents", tmp_path / "ab-hello_0.0.1_amd64.deb"],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    assert "usr/bin/ab-hello" in contents.stdout
+
+
+def test_parallel_gzip_writer_round_trip():
+    data = b"".join(b"line %d\n" % i for i in range(100_000))
+    assert len(data) > 4 * build_deb.GZIP_BLOCK_SIZE
+
+    outputs = []
+    for workers in (1, 2, 4):
+        buf = BytesIO()
+        with build_deb._ParallelGzipWriter(buf, workers=workers) as stream:
+            stream.write(data[:1000])
+            stream.write(data[1000:])
+        outputs.append(buf.getvalue())
+
+    assert gzip.decompress(outputs[0]) == data
+    # every block but the last ends with a sync flush marker
+    assert outputs[0].count(b"\x00\x00\xff\xff") >= 4
+    assert outputs[1] == outputs[0]
+    assert outputs[2] == outputs[0]
+
+
+@pytest.mark.parametrize("pigz", [None, shutil.which("gzip")])
+def test_create_tar_gz_bytes_is_reproducible(monkeypatch, pigz):
+    monkeypatch.setattr(build_deb, "PIGZ", pigz)
+    files = [TextTarFileSpec(path="usr/bin/hello", mode=0o755, content="hi\n")]
+    archive = create_tar_gz_bytes(files, base_dir="usr")
+
+    # no timestamp in the gzip header, and none on the entries
+    assert archive[4:8] == b"\0\0\0\0"
+    with tarfile.open(fileobj=BytesIO(archive)) as tar:
+        assert {(m.mtime, m.uid, m.gid) for m in tar} == {(0, 0, 0)}
+    assert create_tar_gz_bytes(files, base_dir="usr") == archive
+
+
+def test_build_deb_is_reproducible(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    build_deb.build_deb(_hello_config())
+    first = (tmp_path / "ab-hello_0.0.1_amd64.deb").read_bytes()
+    build_deb.build_deb(_hello_config())
+
+    assert (tmp_path / "ab-hello_0.0.1_amd64.deb").read_bytes() == first
+
+
+def test_control_extras_render():
+    control = ControlExtras(depends="libc6", maintainer="Me <me@example.com>")
+    meta = PackageMeta(name="ab-hello", version="0.0.1", arch="amd64")
+
+    assert control.render(meta) == (
+        "Package: ab-hello\n"
+        "Version: 0.0.1\n"
+        "Depends: libc6\n"
+        "Recommends: \n"
+        "Section: main\n"
+        "Priority: optional\n"
+        "Homepage: \n"
+        "Architecture: amd64\n"
+        "Installed-Size: 10\n"
+        "Maintainer: Me <me@example.com>\n"
+        "Description:\n"
+    )
+
+
+class _FullDisk:
+    def write(self, data):
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+
+@pytest.mark.skipif(not shutil.which("gzip"), reason="gzip not installed")
+def test_pipe_through_reports_destination_errors(monkeypatch):
+    monkeypatch.setattr(build_deb, "PIGZ", shutil.which("gzip"))
+    files = [BinaryTarFileSpec(path="blob", mode=None, content=os.urandom(1 << 22))]
+
+    with pytest.raises(OSError) as exc_info:
+        build_deb.create_tar_gz(_FullDisk(), files)
+    assert exc_info.value.errno == errno.ENOSPC
+
+
+@pytest.mark.skipif(not shutil.which("false"), reason="false not installed")
+@pytest.mark.parametrize("size", [1, 1 << 22])
+def test_pipe_through_reports_compressor_failure(monkeypatch, size):
+    monkeypatch.setattr(build_deb, "PIGZ", shutil.which("false"))
+    files = [BinaryTarFileSpec(path="blob", mode=None, content=b"x" * size)]
+
+    with pytest.raises(subprocess.CalledProcessError):
+        create_tar_gz_bytes(files)
+
+
+def test_reassigned_content_is_archived():
+    text = TextTarFileSpec(path="text", mode=None, content="old")
+    binary = BinaryTarFileSpec(path="binary", mode=None, content=b"old")
+    text.content = "new-content"
+    binary.content = b"new-content"
+
+    with tarfile.open(fileobj=BytesIO(create_tar_gz_bytes([text, binary]))) as tar:
+        assert tar.extractfile("text").read() == b"new-content"
+        assert tar.extractfile("binary").read() == b"new-content"